@@ -5,10 +5,13 @@
 import configparser
 import csv
 from collections import namedtuple
+from dataclasses import dataclass
+from itertools import islice
 from pathlib import Path
 
-from reportlab.lib.utils import simpleSplit
+from reportlab.lib import pagesizes, units
 from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
 
 BASEDIR = Path(__file__).parent
@@ -16,9 +19,73 @@ BASEDIR = Path(__file__).parent
 CONFIG = configparser.ConfigParser(inline_comment_prefixes="#")
 CONFIG.read((BASEDIR / "config", BASEDIR / "config.local"))
 
-Label = namedtuple(
-    "Label", ("name", "address", "postalcode", "city", "country")
-)
+# widths of the words printed so far, by (word, fontface, fontsize)
+_WORDWIDTHS = {}
+
+# names of the fonts registered by installfont
+_INSTALLEDFONTS = set()
+
+
+@dataclass(slots=True, frozen=True)
+class Label:
+    """A single address to print on a label."""
+
+    name: str
+    address: str
+    postalcode: str
+    city: str
+    country: str
+    citypc: str  # postal code and city, as printed on the label
+
+
+def wordwidth(word, fontface, fontsize):
+    """Get the printed width of a word, measuring each word only once."""
+    key = (word, fontface, fontsize)
+    try:
+        return _WORDWIDTHS[key]
+    except KeyError:
+        width = _WORDWIDTHS[key] = pdfmetrics.stringWidth(
+            word, fontface, fontsize
+        )
+        return width
+
+
+def wrap_cached(text, fontface, fontsize, maxwidth):
+    """Split text into lines no wider than maxwidth.
+
+    Greedily packs words like reportlab's simpleSplit does, but reuses word
+    widths and only joins every line once, from a slice of the words.
+    """
+    if (
+        "\n" not in text
+        and pdfmetrics.stringWidth(text, fontface, fontsize) <= maxwidth
+    ):
+        # most fields fit on a single line, no need to measure every word
+        words = text.split()
+        return [" ".join(words)] if words else []
+
+    spacewidth = wordwidth(" ", fontface, fontsize)
+    lines = []
+    for paragraph in text.split("\n"):
+        words = paragraph.split()
+        start = 0
+        linewidth = -spacewidth
+        for index, word in enumerate(words):
+            key = (word, fontface, fontsize)
+            try:
+                width = _WORDWIDTHS[key]
+            except KeyError:
+                width = _WORDWIDTHS[key] = pdfmetrics.stringWidth(
+                    word, fontface, fontsize
+                )
+            linewidth += spacewidth + width
+            if linewidth > maxwidth and index > start:
+                lines.append(" ".join(words[start:index]))
+                start = index
+                linewidth = width
+        if words:
+            lines.append(" ".join(words[start:]))
+    return lines
 
 
 class FontFileNotFound(Exception):
@@ -32,21 +99,55 @@ class CanvasWithFontState(canvas.Canvas):
 
     Font = namedtuple("Font", ("face", "size"))
 
-    def __init__(self, filename, pagesize):
-        """Initialize a new canvas."""
-        self._currentfont = self.Font("Courier", 12)
+    def __init__(self, filename, pagesize, extralinespacing=0):
+        """Initialize a new canvas.
+
+        The extralinespacing is the fraction of the leading to put in between
+        paragraphs, see baselineskip.
+        """
+        self._extralinespacing = extralinespacing
         super().__init__(filename, pagesize=pagesize)
+        self._storefont(self._fontname, self._fontsize)
+
+    def _storefont(self, fontface, fontsize):
+        """Store the given font, along with the spacing it comes with."""
+        self._currentfont = self.Font(fontface, fontsize)
+        self._currentleading = self._leading
+        self._baselineskip = self._leading * self._extralinespacing
 
     def set_current_font(self, fontface, fontsize):
-        """Set and store the given font to the canvas."""
+        """Set and store the given font to the canvas.
+
+        Does nothing if that font is already the current one.
+        """
+        if (fontface, fontsize) == self._currentfont:
+            return
         self.setFont(fontface, fontsize)
-        self._currentfont = self.Font(fontface, fontsize)
+        self._storefont(fontface, fontsize)
+
+    def showPage(self):
+        """Close the current page and start a new one.
+
+        Reportlab resets the font on every new page, so we do as well.
+        """
+        super().showPage()
+        self._storefont(self._fontname, self._fontsize)
 
     @property
     def currentfont(self):
         """Return the currently set font of this canvas."""
         return self._currentfont
 
+    @property
+    def leading(self):
+        """Return the distance between lines in the current font."""
+        return self._currentleading
+
+    @property
+    def baselineskip(self):
+        """Return the extra distance between paragraphs in the current font."""
+        return self._baselineskip
+
 
 class LineWriter:
     """Convenience class to hold methods to aid in line writing.
@@ -62,47 +163,41 @@ class LineWriter:
     @property
     def baselineskip(self):
         """Get the baselineskip."""
-        # pylint: disable=protected-access
-        # I see no other way?
-        return self.canvas._leading
-
-    def numlines(self, text):
-        """Get the number of lines this text would take to print."""
-        return len(simpleSplit(text, *self.canvas.currentfont, self.maxwidth))
-
-    def textheight(self, text):
-        """Get the height the given text would consume to be printed."""
-        return self.baselineskip * self.numlines(text)
-
-    def writetext(self, pos_x, pos_y, text):
-        """Print text centred at pos_x, pos_y on the given canvas.
+        return self.canvas.leading
 
-        If text is wider than maxwidth, it is wrapped on multiple lines.
+    def layout(self, text):
+        """Split text into lines fitting maxwidth in the current font."""
+        return wrap_cached(text, *self.canvas.currentfont, self.maxwidth)
 
-        Returns the number of lines written.
-        """
-        textlines = simpleSplit(text, *self.canvas.currentfont, self.maxwidth)
+    def draw_lines(self, pos_x, pos_y, textlines):
+        """Print lines, as returned by layout, centred at pos_x, pos_y."""
+        draw = self.canvas.drawCentredString
+        baselineskip = self.baselineskip
         for line in textlines:
-            self.canvas.drawCentredString(pos_x, pos_y, line)
-            pos_y -= self.baselineskip
+            draw(pos_x, pos_y, line)
+            pos_y -= baselineskip
 
-        return len(textlines)
 
+def simplecsvreader(addressfile):
+    """Read rows from a csv file by splitting its lines on commas.
 
-def baselineskip(acanvas):
-    """Calculate the baselineskip."""
-    # pylint: disable=protected-access
-    # I see no other way?
-    return acanvas._leading * CONFIG["addresslabels"].getfloat(
-        "extralinespacing"
-    )
+    Much faster than csv.reader, but only for files without quoted fields
+    spanning multiple lines. Lines with quotes are still parsed by csv.reader.
+    """
+    for line in addressfile:
+        if '"' in line:
+            yield from csv.reader((line,))
+        else:
+            yield line.rstrip("\r\n").split(",")
 
 
 def loadcsv(csvfile):
-    """Load addresses from the csv file into a List of Labels."""
-    labels = []
+    """Load addresses from the csv file, yielding a Label per row."""
     with open(csvfile, "r", newline="", encoding="utf-8") as addressfile:
-        addressreader = csv.reader(addressfile)
+        if CONFIG["addresslabels"].getboolean("simplecsv"):
+            addressreader = simplecsvreader(addressfile)
+        else:
+            addressreader = csv.reader(addressfile)
         for index, row in enumerate(addressreader):
             try:
                 if row[0][0] == CONFIG["addresslabels"]["ignorelineprefix"]:
@@ -113,14 +208,15 @@ def loadcsv(csvfile):
                     f"{csvfile}."
                 )
             try:
-                labels.append(
-                    Label(
-                        name=row[0].strip(),
-                        address=row[1].strip(),
-                        postalcode=row[2].strip(),
-                        city=row[3].strip(),
-                        country=row[4].strip(),
-                    )
+                postalcode = row[2].strip()
+                city = row[3].strip()
+                label = Label(
+                    name=row[0].strip(),
+                    address=row[1].strip(),
+                    postalcode=postalcode,
+                    city=city,
+                    country=row[4].strip(),
+                    citypc=f"{postalcode} {city}",
                 )
             except IndexError:
                 print(
@@ -128,40 +224,33 @@ def loadcsv(csvfile):
                     "not enough columns. "
                     "(skipping and continuing anyway)"
                 )
-
-    return labels
+            else:
+                yield label
 
 
-# pylint: disable=too-many-statements
+# pylint: disable=too-many-statements,too-many-locals
 # Sorry...
 def main():
     """Generate PDF to print on address sticker sheets."""
-    unit = getattr(
-        __import__(
-            "reportlab.lib.units", fromlist=[CONFIG["addresslabels"]["unit"]]
-        ),
-        CONFIG["addresslabels"]["unit"],
-    )
-
-    dimensions = {}
-    for dimension in CONFIG["dimensions"]:
-        dimensions[dimension] = (
-            CONFIG["dimensions"].getfloat(dimension, 0) * unit
-        )
-
-    pagesize = getattr(
-        __import__(
-            "reportlab.lib.pagesizes",
-            fromlist=[CONFIG["addresslabels"]["pagesize"]],
-        ),
-        CONFIG["addresslabels"]["pagesize"],
-    )
+    unit = getattr(units, CONFIG["addresslabels"]["unit"])
+    dimensions = {
+        dimension: CONFIG["dimensions"].getfloat(dimension, 0) * unit
+        for dimension in CONFIG["dimensions"]
+    }
+    pagesize = getattr(pagesizes, CONFIG["addresslabels"]["pagesize"])
+
+    width_label = dimensions["width_label"]
+    height_label = dimensions["height_label"]
+    margin_label_right = dimensions["margin_label_right"]
+    margin_label_top = dimensions["margin_label_top"]
 
     print(" * Reading " + CONFIG["addresslabels"]["csvfile"])
     labels = loadcsv(CONFIG["addresslabels"]["csvfile"])
 
     canv = CanvasWithFontState(
-        CONFIG["addresslabels"]["pdffile"], pagesize=pagesize
+        CONFIG["addresslabels"]["pdffile"],
+        pagesize=pagesize,
+        extralinespacing=CONFIG["addresslabels"].getfloat("extralinespacing"),
     )
     canv.setTitle("Address labels")
     canv.setAuthor("addresslabels.py <bbb@bbbart.be>")
@@ -170,106 +259,131 @@ def main():
         ("address", "addresses", "label", "labels", "sticker", "stickers")
     )
 
-    linewriter = LineWriter(
-        canv, dimensions["width_label"] - dimensions["pad_label"]
-    )
+    linewriter = LineWriter(canv, width_label - dimensions["pad_label"])
 
-    x_label = x_label_orig = dimensions["margin_page_left"]
-    y_label = y_label_orig = pagesize[1] - (
-        dimensions["margin_page_top"] + dimensions["height_label"]
+    drawborders = CONFIG["addresslabels"].getboolean("drawborders")
+    font_name = (
+        CONFIG["fonts"]["fontname_name"],
+        CONFIG["fonts"].getint("fontsize_name"),
+    )
+    font_address = (
+        CONFIG["fonts"]["fontname_address"],
+        CONFIG["fonts"].getint("fontsize_address"),
     )
 
-    # pylint: disable=protected-access
-    # I see no other way?
-    def addlabel(x_label, y_label, label):
-        """Add the given label to the given position on the current page."""
-        if CONFIG["addresslabels"].getboolean("drawborders"):
-            canv.rect(
-                x_label,
-                y_label,
-                dimensions["width_label"],
-                dimensions["height_label"],
-            )
-
-        # calculating the height of the label for vertical positioning
-        textheight = 0
-        canv.set_current_font(
-            CONFIG["fonts"]["fontname_name"],
-            CONFIG["fonts"].getint("fontsize_name"),
-        )
-        textheight += linewriter.textheight(label.name)
-        textheight += baselineskip(canv)
-        canv.set_current_font(
-            CONFIG["fonts"]["fontname_address"],
-            CONFIG["fonts"].getint("fontsize_address"),
-        )
-        textheight += linewriter.textheight(label.address)
-        textheight += baselineskip(canv)
-        textheight += linewriter.textheight(f"{label.postalcode} {label.city}")
-        if label.country:
-            textheight += baselineskip(canv)
-            textheight += linewriter.textheight(label.country)
-
-        canv.set_current_font(
-            CONFIG["fonts"]["fontname_name"],
-            CONFIG["fonts"].getint("fontsize_name"),
-        )
-
-        x_name = x_label + dimensions["width_label"] / 2
-        y_name = (
-            y_label
-            + dimensions["height_label"] / 2
-            + textheight / 2
-            - canv._leading
-        )
-        numlines = linewriter.writetext(x_name, y_name, label.name)
-
-        canv.set_current_font(
-            CONFIG["fonts"]["fontname_address"],
-            CONFIG["fonts"].getint("fontsize_address"),
-        )
-
-        x_address = x_name
-        y_address = y_name - numlines * canv._leading - baselineskip(canv)
-        numlines = linewriter.writetext(x_address, y_address, label.address)
-
-        y_address -= numlines * canv._leading + baselineskip(canv)
-        numlines = linewriter.writetext(
-            x_address, y_address, f"{label.postalcode} {label.city}"
-        )
-
-        if label.country:
-            y_address -= numlines * canv._leading + baselineskip(canv)
-            numlines = linewriter.writetext(
-                x_address, y_address, label.country
-            )
-
-        x_label += dimensions["width_label"] + dimensions["margin_label_right"]
-        if x_label > pagesize[0] - dimensions["width_label"]:
-            x_label = x_label_orig
-            y_label -= (
-                dimensions["height_label"] + dimensions["margin_label_top"]
-            )
-            if y_label < 0:
-                y_label = y_label_orig
-
-        return x_label, y_label
-
-    x_label, y_label = addlabel(x_label_orig, y_label_orig, labels[0])
-    for label in labels[1:]:
-        if x_label == x_label_orig and y_label == y_label_orig:
+    # all pages share the same grid of label positions, so work it out once
+    x_first = dimensions["margin_page_left"]
+    y_first = pagesize[1] - (dimensions["margin_page_top"] + height_label)
+    x_step = width_label + margin_label_right
+    y_step = height_label + margin_label_top
+    # (with some tolerance for labels ending exactly at the page's edge)
+    columns = (
+        int((max(0, pagesize[0] - width_label - x_first) + 1e-6) // x_step)
+        + 1
+    )
+    rows = int((max(0, y_first) + 1e-6) // y_step) + 1
+    positions = [
+        (x_first + column * x_step, y_first - row * y_step)
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+    def addpage(labels):
+        """Add the given labels to the positions on the current page.
+
+        First plans where every line of every label goes, then prints the
+        names and the addresses in two batches, so each font is set only
+        once per page.
+        """
+        cells = positions[: len(labels)]
+        if drawborders:
+            borders = canv.beginPath()
+            for x_label, y_label in cells:
+                borders.rect(x_label, y_label, width_label, height_label)
+            canv.drawPath(borders, fill=0)
+
+        layout = linewriter.layout
+        draw_lines = linewriter.draw_lines
+
+        # splitting every field only once, for measuring and printing alike
+        canv.set_current_font(*font_name)
+        leading_name = canv.leading
+        skip_name = canv.baselineskip
+        names = [layout(label.name) for label in labels]
+
+        canv.set_current_font(*font_address)
+        leading_address = canv.leading
+        skip_address = canv.baselineskip
+        plan = []
+        for (x_label, y_label), name_lines, label in zip(cells, names, labels):
+            blocks = [
+                layout(label.address),
+                layout(label.citypc),
+            ]
+            if label.country:
+                blocks.append(layout(label.country))
+
+            textheight = 0
+            textheight += leading_name * len(name_lines)
+            textheight += skip_name
+            for index, lines in enumerate(blocks):
+                if index:
+                    textheight += skip_address
+                textheight += leading_address * len(lines)
+
+            x_name = x_label + width_label / 2
+            y_name = y_label + height_label / 2 + textheight / 2 - leading_name
+
+            y_address = y_name
+            numlines = len(name_lines)
+            y_blocks = []
+            for lines in blocks:
+                y_address -= numlines * leading_address + skip_address
+                y_blocks.append(y_address)
+                numlines = len(lines)
+
+            plan.append((x_name, y_name, y_blocks, blocks))
+
+        # names can only be placed once the address blocks are measured, so
+        # print the addresses first, while their font is still active
+        for x_name, _, y_blocks, blocks in plan:
+            for y_address, lines in zip(y_blocks, blocks):
+                draw_lines(x_name, y_address, lines)
+
+        canv.set_current_font(*font_name)
+        for (x_name, y_name, _, _), name_lines in zip(plan, names):
+            draw_lines(x_name, y_name, name_lines)
+
+    pagelabels = list(islice(labels, len(positions)))
+    while pagelabels:
+        addpage(pagelabels)
+        pagelabels = list(islice(labels, len(positions)))
+        if pagelabels:
             canv.showPage()
-        x_label, y_label = addlabel(x_label, y_label, label)
 
     print(" * Writing " + CONFIG["addresslabels"]["pdffile"])
     canv.save()
 
 
 def installfont(fontname):
-    """Register a typeface and font based on the given name."""
+    """Register a typeface and font based on the given name.
+
+    A TrueType font is preferred over a Type 1 font, as reportlab embeds only
+    the glyphs used from it. Fonts are installed only once.
+    """
+    if fontname in _INSTALLEDFONTS:
+        return
+
+    fontfile_stem = fontname
+    fontdir_ttf = Path(CONFIG["fonts"]["fontdir_ttf"])
+    ttf = (fontdir_ttf / fontfile_stem).with_suffix(".ttf")
+    if ttf.is_file():
+        pdfmetrics.registerFont(TTFont(fontname, ttf))
+        _INSTALLEDFONTS.add(fontname)
+        return
+
     fontdir_afm = Path(CONFIG["fonts"]["fontdir_afm"])
     fontdir_pfb = Path(CONFIG["fonts"]["fontdir_pfb"])
-    fontfile_stem = fontname
     afm = (fontdir_afm / fontfile_stem).with_suffix(".afm")
     pfb = (fontdir_pfb / fontfile_stem).with_suffix(".pfb")
 
@@ -281,8 +395,9 @@ def installfont(fontname):
     except AssertionError as asserr:
         raise FontFileNotFound(
             f"Cannot install font {fontname}. "
-            "Do its .afm and .pfb files exist?"
+            "Do its .ttf or its .afm and .pfb files exist?"
         ) from asserr
+    _INSTALLEDFONTS.add(fontname)
 
 
 if __name__ == "__main__":